@@ -1,5 +1,5 @@
 from .api import AsyncPyCloud
-from .exceptions import ApiError, NoSessionError, NoTokenError
+from .exceptions import ApiError, CircuitOpenError, NoSessionError, NoTokenError
 from .utils import __version__
 
-__all__ = ["ApiError", "AsyncPyCloud", "NoSessionError", "NoTokenError", "__version__"]
+__all__ = ["ApiError", "AsyncPyCloud", "CircuitOpenError", "NoSessionError", "NoTokenError", "__version__"]
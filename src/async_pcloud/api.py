@@ -1,33 +1,142 @@
-import json
+import asyncio
+import inspect
+import io
+import logging
+import random
+import time
+from collections import OrderedDict, deque
 from hashlib import sha1
+from types import MappingProxyType
 from typing import ClassVar
 
 import aiohttp
+import orjson
 from anyio import Path
+from yarl import URL
 
-from .exceptions import ApiError, NoSessionError, NoTokenError
-from .utils import __version__, log, to_api_datetime
+from .exceptions import ApiError, CircuitOpenError, NoSessionError, NoTokenError
+from .utils import __version__, fix_path, log, to_api_datetime
 from .validate import MODE_AND, RequiredParameterCheck
 
+CB_CLOSED = "closed"
+CB_OPEN = "open"
+CB_HALF_OPEN = "half_open"
+# small API calls fail fast, uploads and downloads only have the session socket timeouts
+API_TIMEOUT = aiohttp.ClientTimeout(total=10, sock_connect=5)
+
+
+def _redact_url(url: URL):
+    if "auth" in url.query:
+        return url.update_query(auth="***")
+    return url
+
+
+async def _on_request_start(session, ctx, params: aiohttp.TraceRequestStartParams):
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    log.debug("Request: %s %s", params.method, _redact_url(params.url))
+
+
+async def _on_request_end(session, ctx, params: aiohttp.TraceRequestEndParams):
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    log.debug("Response: %d %s %s", params.response.status, params.response.reason, _redact_url(params.url))
+
+
+def _trace_config():
+    """Logs requests from inside aiohttp, instead of in every request helper."""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    return trace_config
+
 
 class AsyncPyCloud:
     """Simple async wrapper for PCloud API."""
-    endpoints: ClassVar = {
+    __slots__ = (
+        "__version__",
+        "__weakref__",
+        "_cb_opened_at",
+        "_cb_state",
+        "_cb_window",
+        "_etag_cache",
+        "_link_cache",
+        "_provide_session",
+        "_sem",
+        "_urls",
+        "api_timeout",
+        "cb_cooldown",
+        "cb_min_calls",
+        "cb_threshold",
+        "endpoint",
+        "etag_cache_size",
+        "folder",
+        "headers",
+        "link_cache_size",
+        "link_cache_ttl",
+        "max_conns",
+        "max_inflight",
+        "max_per_host",
+        "max_retries",
+        "retry_base",
+        "retry_cap",
+        "session",
+        "token",
+    )
+    endpoints: ClassVar = MappingProxyType({
         "api": "https://api.pcloud.com/",
         "eapi": "https://eapi.pcloud.com/",
         "test": "http://localhost:5023/",
-    }
-
-    def __init__(self, token, endpoint="eapi", folder=None, headers=None, session=None):
+    })
+    _endpoint_names: ClassVar = ", ".join(endpoints)
+    retry_statuses: ClassVar = frozenset({429, 500, 502, 503, 504})
+    # methods without side effects, safe to resend after a timeout or a dropped connection
+    read_only_methods: ClassVar = frozenset({
+        "getdigest", "userinfo", "supportedlanguages", "currentserver", "diff", "getfilehistory", "getip",
+        "getapiserver", "listfolder", "uploadprogress", "checksumfile", "stat", "search", "userinvites",
+        "listtokens", "getfilelink", "getvideolinks", "extractarchiveprogress", "savezipprogress",
+        "listshares", "listpublinks", "listplshort", "showpublink", "trash_list",
+    })
+    # GET methods that are safe to revalidate with If-None-Match
+    etag_methods: ClassVar = frozenset({"listfolder", "stat", "userinfo", "listtokens", "userinvites"})
+
+    def __init__(
+        self, token, endpoint="eapi", folder=None, headers=None, session=None, max_conns=100, max_per_host=20, max_inflight=16,
+        max_retries=3, *, api_timeout=API_TIMEOUT, retry_base=0.5, retry_cap=8.0, etag_cache_size=256,
+        link_cache_ttl=60.0, link_cache_size=512, cb_window_size=20, cb_min_calls=5, cb_threshold=0.5, cb_cooldown=30.0,
+    ):
         self.token = token
         self.folder = folder
+        self.max_conns = max_conns
+        self.max_per_host = max_per_host
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.api_timeout = api_timeout
+        # backoff for transient failures, seconds
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.etag_cache_size = etag_cache_size
+        # file links expire after a few hours, reuse them for a short while
+        self.link_cache_ttl = link_cache_ttl
+        self.link_cache_size = link_cache_size
+        # circuit breaker, opens when cb_threshold of the last cb_window_size calls failed
+        self.cb_min_calls = cb_min_calls
+        self.cb_threshold = cb_threshold
+        self.cb_cooldown = cb_cooldown
+        self._cb_state = CB_CLOSED
+        self._cb_opened_at = 0.0
+        self._cb_window = deque(maxlen=cb_window_size)
+        self._etag_cache: OrderedDict[tuple[str, frozenset], tuple[str, bytes]] = OrderedDict()
+        self._link_cache: OrderedDict[tuple[str, int], tuple[float, str]] = OrderedDict()
+        self._sem = None
         self.headers = headers or {"User-Agent": f"async_pcloud/{__version__}"}
         self.__version__ = __version__
         valid_endpoint = self.endpoints.get(endpoint)
-        if not valid_endpoint:
-            msg = f"Endpoint ({endpoint}) not found. Use one of: {', '.join(self.endpoints.keys())}"
+        if valid_endpoint is None:
+            msg = f"Endpoint ({endpoint}) not found. Use one of: {self._endpoint_names}"
             raise ValueError(msg)
         self.endpoint = valid_endpoint
+        self._urls: dict[tuple[str, str], URL] = {}
         self._provide_session = session is None
         if session:
             session = self._get_session()
@@ -45,8 +154,20 @@ class AsyncPyCloud:
 
     async def connect(self):
         """Creates a session, must be called before any requests."""
+        self._get_semaphore()
         if not self.session and self._provide_session:
-            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(10), raise_for_status=True)
+            connector = aiohttp.TCPConnector(
+                limit=self.max_conns,
+                limit_per_host=self.max_per_host,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=10),
+                raise_for_status=True,
+                trace_configs=[_trace_config()],
+            )
             log.debug("Connected.")
         else:
             log.debug("Session already exists.")
@@ -56,6 +177,7 @@ class AsyncPyCloud:
             await self.session.close()
             log.debug("Disconnected.")
             self.session = None
+            self._sem = None
         else:
             log.debug("No session to disconnect.")
 
@@ -76,20 +198,20 @@ class AsyncPyCloud:
             raise TypeError(msg)
         return self.session
 
-    def _fix_path(self, path: str):
-        if not path.startswith("/"):
-            path = "/" + path
-        if self.folder:
-            path = f"/{self.folder}{path}"
-        return path.removesuffix("/")
-
-    @staticmethod
-    def _redact_auth(data: dict):
-        # this is genius
-        data_copy = data.copy()
-        if "auth" in data_copy:
-            data_copy["auth"] = "***"
-        return data_copy
+    def _get_semaphore(self):
+        # created lazily, semaphore must be made inside a running loop
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_inflight)
+        return self._sem
+
+    def _url(self, method: str):
+        """Full URL for an API method, parsed once and reused."""
+        # endpoint can be changed at runtime, e.g. to the one from getapiserver
+        key = (self.endpoint, method)
+        url = self._urls.get(key)
+        if url is None:
+            url = self._urls[key] = URL(self.endpoint + method)
+        return url
 
     def _prepare_params(self, params=None, *, auth=True, **kwargs):
         """Converts kwargs to params, and does auth check."""
@@ -100,37 +222,183 @@ class AsyncPyCloud:
             raise NoTokenError
         if auth and not new_params.get("auth"):
             new_params["auth"] = self.token
-        if new_params.get("path"):
-            new_params["path"] = self._fix_path(new_params["path"])
+        path = new_params.get("path")
+        if path:
+            new_params["path"] = fix_path(path, self.folder)
         return new_params
 
-    async def _do_request(self, url: str, method="GET", data=None, params=None, *, auth=True, **kwargs):
-        if params is None:
-            params = {}
+    @staticmethod
+    def _is_transient(response_json: dict):
+        # 4xxx are rate limits, 5xxx are server side errors
+        return 4000 <= response_json.get("result", 0) < 6000
+
+    def _retry_delay(self, attempt: int, headers=None):
+        """Full jitter backoff, Retry-After header wins if the server sent one (capped at retry_cap)."""
+        retry_after = headers.get("Retry-After") if headers else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.retry_cap)
+        return random.uniform(0, min(self.retry_cap, self.retry_base * 2 ** attempt))
+
+    def _cb_check(self):
+        """Raises if the circuit is open, lets one probe call through after the cooldown."""
+        if self._cb_state == CB_CLOSED:
+            return
+        if self._cb_state == CB_OPEN and time.monotonic() - self._cb_opened_at >= self.cb_cooldown:
+            log.debug("Circuit half open, sending a probe.")
+            self._cb_state = CB_HALF_OPEN
+            return
+        raise CircuitOpenError
+
+    def _cb_open(self):
+        log.warning("Too many failed requests, circuit open for %.0fs.", self.cb_cooldown)
+        self._cb_state = CB_OPEN
+        self._cb_opened_at = time.monotonic()
+
+    def _cb_record(self, *, failed: bool):
+        if self._cb_state == CB_HALF_OPEN:
+            if failed:
+                self._cb_open()
+            else:
+                log.debug("Probe succeeded, circuit closed.")
+                self._cb_state = CB_CLOSED
+                self._cb_window.clear()
+            return
+        self._cb_window.append(failed)
+        window = self._cb_window
+        if len(window) >= self.cb_min_calls and sum(window) / len(window) >= self.cb_threshold:
+            self._cb_open()
+
+    async def _do_request(self, url: str, method="GET", data=None, params=None, *, auth=True, timeout=None, **kwargs):
         session = self._get_session()
         params = self._prepare_params(params, auth=auth, **kwargs)
-        log.debug("Request: %s %s %s", method, url, self._redact_auth(params))
-        # add endpoint
-        url = self.endpoint + url
-        async with session.request(method, url, data=data, params=params, headers=self.headers) as response:
-            response.raise_for_status()
-            response_json: dict = await response.json()
-            log.debug("Response: %s %d %s", response_json, response.status, response.reason)
-            return response_json
+        # logins are never cached or retried
+        login = "getauth" in params
+        cache_key = None if login else self._etag_key(url, method, params)
+        return await self._guarded_request(session, url, method, data, params, timeout, cache_key=cache_key, login=login)
 
-    async def _get_text(self, url: str, params=None, *, auth=True, not_found_ok=False, **kwargs):
-        if params is None:
-            params = {}
+    async def _do_request_fast(self, url: str, *, params_list: list, method="GET", data=None, auth=True, timeout=None):
+        """Like _do_request, for params that are already final (key, value) pairs.
+
+        Skips the kwargs merge, path fixing and the ETag cache, aiohttp takes the list as is.
+        auth is appended to params_list in place, so pass a fresh list. Not for getauth logins.
+        """
+        session = self._get_session()
+        if auth:
+            if not self.token:
+                raise NoTokenError
+            params_list.append(("auth", self.token))
+        return await self._guarded_request(session, url, method, data, params_list, timeout)
+
+    async def _guarded_request(
+        self, session: aiohttp.ClientSession, url: str, method: str, data, params, timeout, *, cache_key=None, login=False,
+    ):
+        """Sends the request through the circuit breaker."""
+        if data is None:
+            timeout = self._api_timeout(timeout)
+        # form data can't be sent twice, and a login retry burns the digest and counts as another try
+        retries = 0 if login or data is not None else self.max_retries
+        self._cb_check()
+        try:
+            response_json = await self._send_request(
+                session, method, self._url(url), data, params,
+                cache_key=cache_key, timeout=timeout, retries=retries,
+            )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            self._cb_record(failed=True)
+            raise
+        except aiohttp.ClientResponseError as e:
+            self._cb_record(failed=e.status in self.retry_statuses)
+            raise
+        except BaseException:
+            # cancelled or unexpected error, don't leave the probe hanging
+            if self._cb_state == CB_HALF_OPEN:
+                self._cb_state = CB_OPEN
+            raise
+        self._cb_record(failed=self._is_transient(response_json))
+        return response_json
+
+    def _etag_key(self, url: str, method: str, params: dict):
+        if method != "GET" or url not in self.etag_methods:
+            return None
+        try:
+            return url, frozenset(params.items())
+        except TypeError:
+            # list values and such, not worth caching
+            return None
+
+    def _store_etag(self, cache_key, etag: str, body: bytes):
+        self._etag_cache[cache_key] = (etag, body)
+        self._etag_cache.move_to_end(cache_key)
+        if len(self._etag_cache) > self.etag_cache_size:
+            self._etag_cache.popitem(last=False)
+
+    async def _send_request(
+        self, session: aiohttp.ClientSession, method: str, url: URL, data, params, *,
+        cache_key=None, timeout=None, retries=0,
+    ):
+        """Sends the request, retrying transient failures up to retries times.
+
+        Failed connects, 429/5xx statuses and 4xxx/5xxx results are always retried, timeouts and
+        dropped connections only for read_only_methods since the server may have run the call.
+        If cache_key is given, the response is revalidated with its ETag and reused on 304,
+        as a fresh dict so callers can't change the cached one.
+        """
+        cached = self._etag_cache.get(cache_key) if cache_key else None
+        headers = {**self.headers, "If-None-Match": cached[0]} if cached else self.headers
+        resendable = url.name in self.read_only_methods
+        attempt = 0
+        while True:
+            last_try = attempt >= retries
+            self._log_untraced_request(method, url, params)
+            try:
+                async with self._get_semaphore(), session.request(
+                    method, url, data=data, params=params, headers=headers, **self._timeout_kwargs(timeout),
+                ) as response:
+                    self._log_untraced_response(response)
+                    response.raise_for_status()
+                    if cached and response.status == 304:
+                        log.debug("Response: not modified, using cached %s", url)
+                        # the entry may have been evicted meanwhile, put it back
+                        self._store_etag(cache_key, *cached)
+                        return orjson.loads(cached[1])
+                    response_json: dict = await response.json(loads=orjson.loads)
+                    etag = response.headers.get("ETag")
+                    if cache_key and etag and response_json.get("result") == 0:
+                        self._store_etag(cache_key, etag, orjson.dumps(response_json))
+            except aiohttp.ClientResponseError as e:
+                if last_try or e.status not in self.retry_statuses:
+                    raise
+                delay = self._retry_delay(attempt, e.headers)
+            except aiohttp.ClientConnectorError:
+                # nothing was sent
+                if last_try:
+                    raise
+                delay = self._retry_delay(attempt)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last_try or not resendable:
+                    raise
+                delay = self._retry_delay(attempt)
+            else:
+                if last_try or not self._is_transient(response_json):
+                    return response_json
+                delay = self._retry_delay(attempt, response.headers)
+            attempt += 1
+            log.debug("Retrying %s in %.2fs (attempt %d/%d)", url, delay, attempt, retries)
+            await asyncio.sleep(delay)
+
+    async def _get_text(self, url: str, params=None, *, auth=True, not_found_ok=False, timeout=None, **kwargs):
         session = self._get_session()
         params = self._prepare_params(params, auth=auth, **kwargs)
-        log.debug("Request: GET (text) %s %s", url, self._redact_auth(params))
-        async with session.get(self.endpoint + url, params=params, headers=self.headers) as response:
+        self._log_untraced_request("GET", self._url(url), params)
+        async with self._get_semaphore(), session.get(
+            self._url(url), params=params, headers=self.headers, **self._timeout_kwargs(self._api_timeout(timeout)),
+        ) as response:
+            self._log_untraced_response(response)
             response.raise_for_status()
-            log.debug("Response: %d %s", response.status, response.reason)
             text = await response.text()
         try:
-            j = json.loads(text)
-        except json.JSONDecodeError:
+            j = orjson.loads(text)
+        except orjson.JSONDecodeError:
             return text
         if j.get("error"):
             log.debug("Bad response: %s", j)
@@ -139,12 +407,42 @@ class AsyncPyCloud:
             raise ApiError(j["error"])
         return text
 
-    async def _default_get(self, url, **kwargs):
+    def _log_untraced_request(self, method: str, url: URL, params):
+        # sessions from connect() log through the trace config
+        if self._provide_session or not log.isEnabledFor(logging.DEBUG):
+            return
+        log.debug("Request: %s %s", method, _redact_url(url.with_query(params)))
+
+    def _log_untraced_response(self, response: aiohttp.ClientResponse):
+        if self._provide_session or not log.isEnabledFor(logging.DEBUG):
+            return
+        log.debug("Response: %d %s %s", response.status, response.reason, _redact_url(response.url))
+
+    def _api_timeout(self, timeout):
+        # sessions we didn't create keep the timeout their owner configured
+        if timeout is None and self._provide_session:
+            return self.api_timeout
+        return timeout
+
+    @staticmethod
+    def _timeout_kwargs(timeout):
+        # only override the session timeout when one was given
+        return {"timeout": timeout} if timeout is not None else {}
+
+    async def _default_get_bytes(self, url, **kwargs):
         session = self._get_session()
         async with session.get(url, **kwargs) as response:
             response.raise_for_status()
             return await response.read()
 
+    async def _default_stream(self, url, chunk_size=1 << 16, **kwargs):
+        """Yields the response body in chunks, so big files don't have to fit in memory."""
+        session = self._get_session()
+        async with session.get(url, **kwargs) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
     # Authentication stuff
     async def getdigest(self):
         resp = await self._do_request("getdigest", auth=False)
@@ -233,9 +531,9 @@ class AsyncPyCloud:
         # TODO: upload chunks (streaming)
         data = kwargs.get("data")
         if data:
-            if isinstance(data, aiohttp.FormData):
+            if isinstance(data, (aiohttp.FormData, aiohttp.MultipartWriter)):
                 return await self._do_request("uploadfile", method="POST", **kwargs)
-            msg = "data must be aiohttp.FormData"
+            msg = "data must be aiohttp.FormData or aiohttp.MultipartWriter"
             raise ValueError(msg)
         files = kwargs.pop("files", [])
         if not files:
@@ -259,8 +557,13 @@ class AsyncPyCloud:
 
     @RequiredParameterCheck(("path", "folderid"))
     async def upload_one_file(self, filename: str, content, **kwargs):
-        if not isinstance(content, bytes) and not isinstance(content, str):
-            msg = "content must be bytes or str"
+        """Uploads content as one file.
+
+        content can be bytes, str, a binary file object or an async iterable of bytes,
+        the last two are streamed instead of read into memory.
+        """
+        if not isinstance(content, (bytes, bytearray, str, io.IOBase)) and not hasattr(content, "__aiter__"):
+            msg = "content must be bytes, str, a binary file or an async iterable of bytes"
             raise TypeError(msg)
         data = aiohttp.FormData()
         data.add_field("filename", content, filename=filename)
@@ -356,18 +659,81 @@ class AsyncPyCloud:
             raise ApiError(response["error"])
         return f"https://{response['hosts'][0]}{response['path']}"
 
+    async def _cached_getfilelink(self, fileid: int, *, not_found_ok=False):
+        """getfilelink by fileid, memoized per token for link_cache_ttl seconds."""
+        now = time.monotonic()
+        # file ids are per account, so the token is part of the key
+        key = (self.token, fileid)
+        cached = self._link_cache.get(key)
+        if cached and now - cached[0] < self.link_cache_ttl:
+            self._link_cache.move_to_end(key)
+            return cached[1]
+        response = await self._do_request_fast("getfilelink", params_list=[("fileid", fileid)])
+        link = self._make_link(response, not_found_ok=not_found_ok)
+        if link is None:
+            return None
+        self._link_cache[key] = (now, link)
+        self._link_cache.move_to_end(key)
+        if len(self._link_cache) > self.link_cache_size:
+            self._link_cache.popitem(last=False)
+        return link
+
     @RequiredParameterCheck(("path", "fileid"))
     async def getfilelink(self, *, not_found_ok=False, **kwargs):
         """Returns a link to the file."""
+        if kwargs.keys() == {"fileid"}:
+            return await self._cached_getfilelink(kwargs["fileid"], not_found_ok=not_found_ok)
         response = await self._do_request("getfilelink", **kwargs)
         return self._make_link(response, not_found_ok=not_found_ok)
 
+    async def get_files(self, files: list[str], folder="/"):
+        """Returns links to the named files in a folder, None for the ones not found.
+
+        Lists the folder once, then fetches all links concurrently.
+        """
+        # the root has no path after fixing, list it by id
+        if fix_path(folder, self.folder):
+            response = await self.listfolder(path=folder)
+        else:
+            response = await self.listfolder(folderid=0)
+        if "metadata" not in response:
+            raise ApiError(response.get("error", response))
+        contents = response["metadata"].get("contents", [])
+        name_to_id = {item["name"]: item["fileid"] for item in contents if not item.get("isfolder")}
+
+        async def link(name):
+            fileid = name_to_id.get(name)
+            if fileid is None:
+                return None
+            return await self.getfilelink(fileid=fileid)
+
+        return await asyncio.gather(*(link(name) for name in files))
+
     @RequiredParameterCheck(("path", "fileid"))
-    async def download_file(self, *, not_found_ok=False, **kwargs):
+    async def download_file(self, *, not_found_ok=False, stream=False, timeout=None, **kwargs):
+        """Downloads the file and returns its bytes.
+
+        stream=True returns an async iterator of chunks instead, if stream is a callable
+        every chunk is passed to it (can be async) and the number of bytes is returned.
+        timeout is an aiohttp.ClientTimeout for the download, by default there is no total limit.
+        """
+        if not isinstance(stream, bool) and not callable(stream):
+            msg = "stream must be a bool or a callable"
+            raise TypeError(msg)
         download_url = await self.getfilelink(not_found_ok=not_found_ok, **kwargs)
         if download_url is None:
             return None
-        return await self._default_get(download_url)
+        if not stream:
+            return await self._default_get_bytes(download_url, **self._timeout_kwargs(timeout))
+        if stream is True:
+            return self._default_stream(download_url, **self._timeout_kwargs(timeout))
+        size = 0
+        async for chunk in self._default_stream(download_url, **self._timeout_kwargs(timeout)):
+            result = stream(chunk)
+            if inspect.isawaitable(result):
+                await result
+            size += len(chunk)
+        return size
 
     @RequiredParameterCheck(("path", "fileid"))
     async def getvideolink(self, **kwargs):
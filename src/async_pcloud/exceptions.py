@@ -13,3 +13,9 @@ class NoTokenError(ApiError):
     """Raised when the token is missing."""
     def __init__(self):
         super().__init__("PCloud token is missing.")
+
+
+class CircuitOpenError(ApiError):
+    """Raised when too many recent requests failed and calls are short-circuited."""
+    def __init__(self):
+        super().__init__("PCloud API looks unavailable, request skipped. Try again later.")
@@ -1,5 +1,6 @@
 import logging
 from datetime import datetime
+from functools import lru_cache
 
 __version__ = "0.3.0"
 log = logging.getLogger("async_pcloud")
@@ -13,3 +14,13 @@ def to_api_datetime(dt):
     if isinstance(dt, datetime):
         return dt.isoformat()
     return dt
+
+
+@lru_cache(maxsize=1024)
+def fix_path(path: str, folder=None):
+    """Makes the path absolute and prepends the base folder. Cached, same paths repeat a lot."""
+    if not path.startswith("/"):
+        path = "/" + path
+    if folder:
+        path = f"/{folder}{path}"
+    return path.removesuffix("/")
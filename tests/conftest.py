@@ -1,41 +1,48 @@
-import json
+import asyncio
 import logging
+from hashlib import sha1
 
 import aiohttp
+import orjson
 import pytest
 from aiohttp import web
-from anyio import Path, open_file
+from anyio import Path
 
 log = logging.getLogger("async_pcloud")
 log.setLevel(logging.DEBUG)
 PORT = 5023
+# static bodies, serialized once
+PASS_BODY = orjson.dumps({"result": 0, "pass": "true"})
+NOT_FOUND_BODY = orjson.dumps({"Error": "Path not found or not accessible!"})
 
 
 @pytest.fixture
 async def start_mock_server():
-    BASE_DIR = Path(__file__).parent
-    DATA_DIR = str(BASE_DIR / "data")
+    DATA_DIR = Path(__file__).parent / "data"
+    # parse every fixture once, requests only look up the serialized body
+    preloaded: dict[str, tuple[bytes, str]] = {}
+    async for file_path in DATA_DIR.glob("*.json"):
+        body = orjson.dumps(orjson.loads(await file_path.read_bytes()))
+        preloaded[file_path.stem] = (body, f'"{sha1(body).hexdigest()}"')
 
     async def generic_get_handler(request: web.Request):
         method = request.path.lstrip("/").split("?")[0]
-        file_path = BASE_DIR / "data" / f"{method}.json"
-        safepath = str(file_path)
         query = request.query_string
         log.debug("Processing Method: %s, query: %s", method, query)
         if method == "gettextfile":
             return web.Response(text="this isnt json", status=200)
-        if not safepath.startswith(DATA_DIR) or not await Path(safepath).exists():
+        payload = preloaded.get(method)
+        if payload is None:
             if query == "auth=TOKEN":
                 # default pass for get methods
-                return web.json_response({"result": 0, "pass": "true"}, status=200)
-            return web.json_response({"Error": "Path not found or not accessible!"}, status=404)
-        async with await open_file(safepath, encoding="utf-8") as f:
-            try:
-                content = await f.read()
-                content = json.loads(content)
-            except json.JSONDecodeError:
-                return web.Response(text="Invalid JSON file", status=500)
-        return web.json_response(content)
+                return web.Response(body=PASS_BODY, content_type="application/json")
+            return web.Response(body=NOT_FOUND_BODY, status=404, content_type="application/json")
+        body, etag = payload
+        if request.headers.get("If-None-Match") == etag:
+            # answer revalidations a bit later, so tests can race other requests against them
+            await asyncio.sleep(0.05)
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
 
     async def generic_post_handler(request: web.Request):
         reader = await request.multipart()
@@ -43,8 +50,8 @@ async def start_mock_server():
         log.debug("Field type: %s", type(field))
         if not isinstance(field, aiohttp.BodyPartReader):
             return web.json_response({"error": "Expected BodyPartReader"}, status=400)
-        if field.name != "file":
-            return web.json_response({"error": "Expected field 'file'"}, status=400)
+        if not field.filename:
+            return web.json_response({"error": "Expected a file field"}, status=400)
         file_content = await field.read()
         size = len(file_content)
         log.debug("File size: %s", size)
@@ -53,8 +60,13 @@ async def start_mock_server():
             "metadata": {"size": size},
         })
 
+    async def file_handler(request: web.Request):
+        return web.FileResponse(DATA_DIR / request.match_info["name"])
+
     app = web.Application()
 
+    # GET: /files/somefile -> raw tests/data/somefile, for downloads
+    app.router.add_route("GET", "/files/{name}", file_handler)
     # GET: /someendpoint -> load tests/data/someendpoint.json
     app.router.add_route("GET", "/{tail:.*}", generic_get_handler)
     # POST: /someupload -> parse multipart upload
@@ -68,3 +80,29 @@ async def start_mock_server():
     yield
     log.debug("Shutting down server...")
     await runner.cleanup()
+
+
+@pytest.fixture
+async def start_flaky_server():
+    """Server on PORT + 1 that hangs on every method, except a rate limited login. Yields hits per method."""
+    hits: dict[str, int] = {}
+
+    async def handler(request: web.Request):
+        method = request.path.lstrip("/")
+        hits[method] = hits.get(method, 0) + 1
+        if method == "getdigest":
+            return web.json_response({"result": 0, "digest": "DIGEST"})
+        if method == "userinfo" and "getauth" in request.query:
+            return web.json_response({"result": 4000, "error": "Too many login tries from this IP."})
+        # not asyncio.sleep, tests patch it out
+        await asyncio.Event().wait()
+        return web.json_response({"result": 0})
+
+    app = web.Application()
+    app.router.add_route("GET", "/{tail:.*}", handler)
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, "localhost", PORT + 1)
+    await site.start()
+    yield hits
+    await runner.cleanup()
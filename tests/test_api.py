@@ -1,8 +1,12 @@
+import asyncio
+import logging
+import weakref
 from pathlib import Path
 
+import aiohttp
 import pytest
 
-from async_pcloud import AsyncPyCloud
+from async_pcloud import ApiError, AsyncPyCloud, CircuitOpenError
 
 
 class DummyPyCloud(AsyncPyCloud):
@@ -31,20 +35,248 @@ class TestPcloudApi:
             assert token == "TOKEN"
             pc.change_token(token)
 
+    async def test_etag_cache(self):
+        async with DummyPyCloud() as client:
+            # logins are not cached
+            await client.get_auth("test@example.com", "password")
+            assert not client._etag_cache
+            first = await client.userinfo()
+            assert len(client._etag_cache) == 1
+            first["auth"] = "changed"
+            # revalidated with the ETag, served from cache as a new dict
+            assert await client.userinfo() == {"result": 0, "auth": "TOKEN"}
+            client.etag_cache_size = 1
+            await client.listfolder(folderid=0)
+            assert [key[0] for key in client._etag_cache] == ["listfolder"]
+
+    async def test_link_cache(self):
+        async with DummyPyCloud() as client:
+            link = await client.getfilelink(fileid=1)
+            assert list(client._link_cache) == [("TOKEN", 1)]
+            assert await client.getfilelink(fileid=1) == link
+            # another account doesn't get the cached link
+            client.change_token("OTHER")
+            await client.getfilelink(fileid=1)
+            assert list(client._link_cache) == [("TOKEN", 1), ("OTHER", 1)]
+
+    async def test_etag_concurrent_revalidation(self):
+        async with DummyPyCloud() as client:
+            client.etag_cache_size = 1
+            await client.userinfo()
+            # listfolder evicts userinfo while its revalidation is in flight
+            userinfo, listfolder = await asyncio.gather(client.userinfo(), client.listfolder(folderid=0))
+            assert userinfo == {"result": 0, "auth": "TOKEN"}
+            assert listfolder["result"] == 0
+            assert len(client._etag_cache) == 1
+
+    async def test_etag_unhashable_params(self):
+        async with DummyPyCloud() as client:
+            response = await client._do_request("getip", fileids=[1, 2])
+            assert response["result"] == 0
+            assert client._etag_key("listfolder", "GET", {"folderid": [0]}) is None
+
     async def test_upload_files(self):
         async with pc:
             testfile = Path(__file__).parent / "data" / "upload.txt"
             res = await pc.uploadfile(files=[testfile])
             assert res == {"result": 0, "metadata": {"size": 14}}
 
+    async def test_upload_one_file(self):
+        async def chunks():
+            yield b"first "
+            yield b"second"
+
+        async with pc:
+            res = await pc.upload_one_file("a.txt", b"some bytes", folderid=0)
+            assert res["metadata"]["size"] == 10
+            with open(Path(__file__).parent / "data" / "upload.txt", "rb") as f:
+                res = await pc.upload_one_file("upload.txt", f, folderid=0)
+            assert res["metadata"]["size"] == 14
+            res = await pc.upload_one_file("b.txt", chunks(), folderid=0)
+            assert res["metadata"]["size"] == 12
+            with pytest.raises(TypeError):
+                await pc.upload_one_file("c.txt", 123, folderid=0)
+
     async def test_get_files(self):
         async with pc:
             assert await pc.getfilelink(fileid=1) == "https://first.pcloud.com/verylonglink/test.txt"
             assert await pc.gettextfile(fileid=1) == "this isnt json"
 
+    async def test_get_files_batch(self):
+        # fresh client, so the links are requested and not taken from the cache
+        async with DummyPyCloud() as client:
+            links = await client.get_files(["test.txt", "docs", "missing.txt"])
+            assert links == ["https://first.pcloud.com/verylonglink/test.txt", None, None]
+
+    async def test_get_files_errors(self, monkeypatch):
+        calls = []
+
+        async def listfolder(**kwargs):
+            calls.append(kwargs)
+            return {"result": 2005, "error": "Directory does not exist."}
+
+        client = DummyPyCloud()
+        monkeypatch.setattr(client, "listfolder", listfolder)
+        with pytest.raises(ApiError, match="Directory does not exist."):
+            await client.get_files(["test.txt"])
+        assert calls == [{"folderid": 0}]
+
+    async def test_download_file(self, monkeypatch):
+        expected = (Path(__file__).parent / "data" / "upload.txt").read_bytes()
+        links = []
+
+        async def getfilelink(**kwargs):
+            links.append(kwargs)
+            return "http://localhost:5023/files/upload.txt"
+
+        async with DummyPyCloud() as client:
+            monkeypatch.setattr(client, "getfilelink", getfilelink)
+            assert await client.download_file(fileid=1) == expected
+            chunks = [chunk async for chunk in await client.download_file(fileid=1, stream=True)]
+            assert b"".join(chunks) == expected
+
+            received = []
+            assert await client.download_file(fileid=1, stream=received.append) == len(expected)
+            assert b"".join(received) == expected
+
+            async def async_sink(chunk):
+                received.append(chunk)
+
+            received.clear()
+            assert await client.download_file(fileid=1, stream=async_sink) == len(expected)
+            assert b"".join(received) == expected
+
+            links.clear()
+            with pytest.raises(TypeError):
+                await client.download_file(fileid=1, stream="yes")
+            assert not links
+
+    async def test_change_endpoint(self):
+        async with DummyPyCloud() as client:
+            await client.getip()
+            client.endpoint = "http://localhost:5024/"
+            client.max_retries = 0
+            # nothing listens there, so the request really went to the new endpoint
+            with pytest.raises(aiohttp.ClientConnectorError):
+                await client.getip()
+
     async def test_other(self):
         async with pc:
             assert await pc.currentserver() == {"result": 0, "ip": "127.0.0.1"}
             check_pass(await pc.supportedlanguages())
             check_pass(await pc.getfilehistory())
             check_pass(await pc.diff())
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr("async_pcloud.api.asyncio.sleep", fake_sleep)
+    return delays
+
+
+async def test_retry_connection_error(no_sleep):
+    delays = no_sleep
+    # no mock server running, every attempt is refused
+    async with DummyPyCloud() as client:
+        client.max_retries = 2
+        with pytest.raises(aiohttp.ClientConnectionError):
+            await client.getip()
+    assert len(delays) == 2
+    assert all(0 <= d <= client.retry_base * 2 for d in delays)
+
+
+async def test_circuit_breaker():
+    async with DummyPyCloud() as client:
+        client.max_retries = 0
+        for _ in range(client.cb_min_calls):
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await client.getip()
+        with pytest.raises(CircuitOpenError):
+            await client.getip()
+        # cooldown over, the probe goes through and fails again
+        client._cb_opened_at -= client.cb_cooldown
+        with pytest.raises(aiohttp.ClientConnectionError):
+            await client.getip()
+        with pytest.raises(CircuitOpenError):
+            await client.getip()
+
+
+async def test_retry_only_read_only_timeouts(start_flaky_server, no_sleep):
+    hits = start_flaky_server
+    timeout = aiohttp.ClientTimeout(total=0.1)
+    async with DummyPyCloud() as client:
+        client.endpoint = "http://localhost:5024/"
+        client.max_retries = 2
+        with pytest.raises(asyncio.TimeoutError):
+            await client.listfolder(folderid=0, timeout=timeout)
+        # the server may have made the folder already, don't send it again
+        with pytest.raises(asyncio.TimeoutError):
+            await client.createfolder(path="/new", timeout=timeout)
+        # logins are never retried
+        response = await client.userinfo(auth=False, params={"getauth": 1})
+        assert response["result"] == 4000
+    assert hits == {"listfolder": 3, "createfolder": 1, "userinfo": 1}
+
+
+def test_retry_after_is_capped():
+    client = DummyPyCloud()
+    assert client._retry_delay(0, {"Retry-After": "3600"}) == client.retry_cap
+    assert client._retry_delay(0, {"Retry-After": "1"}) == 1
+
+
+async def test_own_session_keeps_timeout():
+    client = DummyPyCloud()
+    assert client._api_timeout(None) is client.api_timeout
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
+        client.set_session(session)
+        assert client._api_timeout(None) is None
+        timeout = aiohttp.ClientTimeout(total=1)
+        assert client._api_timeout(timeout) is timeout
+
+
+@pytest.mark.usefixtures("start_mock_server")
+async def test_own_session_logging(caplog):
+    client = DummyPyCloud()
+    async with aiohttp.ClientSession(raise_for_status=True) as session:
+        client.set_session(session)
+        with caplog.at_level(logging.DEBUG, logger="async_pcloud"):
+            await client.getip()
+    assert "Request: GET http://localhost:5023/getip?auth=***" in caplog.text
+    assert "Response: 200 OK" in caplog.text
+
+
+def test_instance_tuning():
+    client = AsyncPyCloud("TOKEN", endpoint="test", cb_cooldown=10, link_cache_size=1)
+    assert client.cb_cooldown == 10
+    assert client.link_cache_size == 1
+    client.api_timeout = aiohttp.ClientTimeout(total=1)
+    client.link_cache_ttl = 0
+    client.cb_cooldown = 5
+    assert client.cb_cooldown == 5
+    assert weakref.ref(client)() is client
+    with pytest.raises(AttributeError):
+        client.something_else = 1
+
+
+@pytest.mark.usefixtures("start_mock_server")
+async def test_no_redaction_without_debug(monkeypatch, caplog):
+    calls = []
+
+    def redact(url):
+        calls.append(url)
+        return url
+
+    monkeypatch.setattr("async_pcloud.api._redact_url", redact)
+    caplog.set_level(logging.WARNING, logger="async_pcloud")
+    async with DummyPyCloud() as client:
+        await client.getip()
+    async with aiohttp.ClientSession(raise_for_status=True) as session:
+        client = DummyPyCloud()
+        client.set_session(session)
+        await client.getip()
+    assert not calls
@@ -1,6 +1,7 @@
 import datetime
 
 from async_pcloud.api import to_api_datetime
+from async_pcloud.utils import fix_path
 
 
 def test_to_api_datetime_dt():
@@ -10,3 +11,9 @@ def test_to_api_datetime_dt():
 
 def test_to_api_datetime_iso():
     assert to_api_datetime("2013-12-05T12:03:12") == "2013-12-05T12:03:12"
+
+
+def test_fix_path():
+    assert fix_path("a/b/") == "/a/b"
+    assert fix_path("/a", "base") == "/base/a"
+    assert fix_path("/") == ""